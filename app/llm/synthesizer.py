@@ -3,7 +3,12 @@ import os
 from typing import Any, Dict, List, Optional
 from anthropic import Anthropic
 
-client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+from app.runtime.singleflight import coalesce
+from app.runtime.resilience import guard
+from app.runtime import capture
+
+# retries are handled by the provider guard, not the SDK
+client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0)
 
 LLM_B_MODEL = "claude-sonnet-4-5-20250929"
 
@@ -81,14 +86,28 @@ CONTEXT:
 {'\n\n'.join(context_parts)}
 """
     
-    resp = client.messages.create(
-        model=LLM_B_MODEL,
-        max_tokens=700,
-        temperature=0.2,
-        system=SYSTEM_PROMPT,
-        messages=[
-            {"role": "user", "content": user_prompt}
-        ],
-    )
-
-    return extract_text(resp)
\ No newline at end of file
+    def call(timeout: float) -> str:
+        resp = client.messages.create(
+            model=LLM_B_MODEL,
+            max_tokens=700,
+            temperature=0.2,
+            system=SYSTEM_PROMPT,
+            messages=[
+                {"role": "user", "content": user_prompt}
+            ],
+            timeout=timeout,
+        )
+        return extract_text(resp)
+
+    # the prompt carries history and all context, so only truly identical turns coalesce
+    return capture.upstream(
+        "synthesize_with_llm_b",
+        lambda: coalesce(
+            "synthesize_with_llm_b",
+            {"model": LLM_B_MODEL, "prompt": user_prompt},
+            lambda: guard("anthropic").call(call),
+            provider="anthropic",
+        ),
+        encode=str,
+        decode=str,
+    )
\ No newline at end of file
@@ -1,22 +1,74 @@
-from typing import Any, Dict, List, Optional
-from pydantic import BaseModel
+from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple
+from pydantic import BaseModel, Field
 from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
 
 from .safety.deterministic import deterministic_safety_check
 from .router.llm_router import route_with_llm
 from .tools.dispatch import run_tools
-from .rag.retriever import retrieve
+from .rag.retriever import retrieve, retrieve_many, preload as preload_rag_index
 from .llm.synthesizer import synthesize_with_llm_b
-
+from .state.conversations import get_history, save_history
+from .tools.fault_codes import load_fault_db
+from .tools.ecu_fitment import load_fitment_data
+from .tools.answers import tool_answer_from_results, template_skip_reason
+from .runtime.singleflight import track_coalesced
+from .runtime.resilience import set_deadline, metrics as provider_metrics
+from .runtime import tracing
+from .runtime import capture
+
+import os
+import json
 import time
 import uuid
-
-CONVERSATIONS: Dict[str, List[Dict[str, str]]] = {}
-
-app = FastAPI(title="Link AI Demo", version="0.4")
+import threading
+import contextvars
+from contextlib import asynccontextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+# upper bound for a whole /chat turn; upstream calls get whatever is left of it
+REQUEST_DEADLINE_S = float(os.getenv("REQUEST_DEADLINE_S", "45"))
+
+# /chat/batch limits
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+# per worker process: how answers were produced
+TURN_COUNTS: Dict[str, int] = {"turns": 0, "generated": 0, "templated": 0, "fallback": 0, "blocked": 0}
+_turn_counts_lock = threading.Lock()
+
+def count_turn(kind: str) -> None:
+    with _turn_counts_lock:
+        TURN_COUNTS["turns"] += 1
+        TURN_COUNTS[kind] += 1
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # uvicorn re-raises SIGTERM once shutdown completes, so atexit never runs in a
+    # server process: write out the queued traces and captured turns here instead
+    tracing.close()
+    capture.close()
+
+app = FastAPI(title="Link AI Demo", version="0.4", lifespan=lifespan)
+
+def preload_assets() -> Dict[str, Any]:
+    """
+    Loads the read-only data (RAG shards, fault codes, fitment table) into this process.
+    Called in the gunicorn master before forking so workers share it copy-on-write.
+    """
+    loaded: Dict[str, Any] = {
+        "fault_codes": len(load_fault_db()),
+        "fitment_rows": len(load_fitment_data()),
+    }
+    try:
+        loaded["rag_shards"] = preload_rag_index()
+    except RuntimeError as e:
+        # index not built yet: retrieval will raise the same error per request
+        loaded["rag_shards_error"] = str(e)
+    return loaded
 
 templates = Jinja2Templates(directory="app/templates")
 
@@ -31,6 +83,9 @@ class ChatRequest(BaseModel):
     user_profile: Dict[str, Any] = {}
     ecu_context: Dict[str, Any] = {}
     attachments: List[Dict[str, Any]] = []
+    deadline_ms: Optional[int] = Field(None, gt=0)
+    # None: deployment default (TRACE_LEVEL)
+    trace_level: Optional[Literal["off", "summary", "full"]] = None
 
 class ChatResponse(BaseModel):
     request_id: str
@@ -40,28 +95,73 @@ class ChatResponse(BaseModel):
     telemetry: Dict[str, Any] = {}
     trace: Dict[str, Any] = {}
 
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest] = Field(..., max_length=BATCH_MAX_ITEMS)
+    max_concurrency: int = Field(BATCH_MAX_CONCURRENCY, ge=1, le=BATCH_MAX_CONCURRENCY)
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
-def tool_answer_from_results(tool_results: Dict[str, Any]) -> str:
-    if tool_results.get("calls"):
-        first = tool_results["calls"][0].get("output", {})
-        if first.get("found"):
-            return (
-                f"**{first['code']} - {first.get('title', '')}**\n\n"
-                f"{first.get('summary', '')}\n\n"
-                f"**Common causes:**\n- " + "\n- ".join(first.get("common_causes", [])) + "\n\n"
-                f"**Safe checks:**\n- " + "\n- ".join(first.get("safe_checks", []))
-            )
-        return f"I couldn't find that fault code in the demo database: {first.get('error')}"
-    return "No tool calls were executed."
+@app.get("/metrics")
+def metrics():
+    # per worker process: how turns were answered, plus concurrency limits, queue depth,
+    # shed counts and breaker state per provider
+    with _turn_counts_lock:
+        turns = dict(TURN_COUNTS)
+    return {
+        "pid": os.getpid(),
+        "turns": turns,
+        "providers": provider_metrics(),
+        "trace_sink": tracing.sink_stats(),
+        "capture": capture.sink_stats(),
+    }
 
-@app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+def fallback_answer(tool_results: Optional[Dict[str, Any]]) -> str:
+    # LLM-B is unavailable: answer deterministically from whatever we already have
+    if tool_results and tool_results.get("calls"):
+        return tool_answer_from_results(tool_results)
+    return (
+        "Sorry, the assistant is busy right now and couldn't put an answer together. "
+        "Please try again in a moment, or contact our support team."
+    )
+
+def mark(turn: Dict[str, Any], stage: str, since: float) -> float:
+    # records how long a pipeline stage took; returns the start time of the next stage
+    now = time.perf_counter()
+    turn["stages_ms"][stage] = round((now - since) * 1000, 1)
+    return now
+
+def respond(turn: Dict[str, Any], route: str, answer: str, citations: List[Dict[str, Any]], telemetry: Dict[str, Any]) -> ChatResponse:
+    telemetry["stages_ms"] = turn["stages_ms"]
+    telemetry["trace_level"] = turn["trace_level"]
+    # the full trace goes to the trace sink; the response carries only what was asked for.
+    # the sinks serialize on another thread, so nothing here may change once it is queued
+    tracing.record(turn["request_id"], route, telemetry, turn["trace"])
+    capture.record(turn, route, answer, telemetry)
+    return ChatResponse(
+        request_id=turn["request_id"],
+        route=route,
+        answer=answer,
+        citations=citations,
+        telemetry=telemetry,
+        trace=tracing.shape(turn["trace"], turn["trace_level"]),
+    )
+
+def prepare_turn(req: ChatRequest, source: str = "chat") -> Dict[str, Any]:
+    """
+    First half of a turn: safety, routing and tool calls.
+    Returns the turn state; "response" is already set if the turn ended here (blocked).
+    source tags the capture log record ("chat" or "batch").
+    """
     request_id = str(uuid.uuid4())
     t0 = time.time()
 
+    deadline_s = REQUEST_DEADLINE_S
+    if req.deadline_ms is not None:
+        deadline_s = min(deadline_s, req.deadline_ms / 1000)
+    set_deadline(deadline_s)
+
     # normalise just a little
     raw_message = req.message
     message = (raw_message or "").strip()
@@ -79,17 +179,37 @@ def chat(req: ChatRequest):
         "execution": {}
     }
 
-    session_id = req.session_id
-
-    history = CONVERSATIONS.get(session_id, [])
-
-
-    citations: List[Dict[str, Any]] = []
+    turn: Dict[str, Any] = {
+        "request_id": request_id,
+        "t0": t0,
+        "deadline_s": deadline_s,
+        "trace_level": tracing.resolve_level(req.trace_level),
+        "request": req.model_dump(),
+        "source": source,
+        "stages_ms": {},
+        # upstream responses for the capture log (None unless CAPTURE_PATH is set)
+        "upstream": capture.begin(),
+        "history": None,
+        "message": message,
+        "session_id": req.session_id,
+        "trace": trace,
+        # upstream calls answered by another request's identical in-flight call
+        "coalesced": track_coalesced(),
+        # stages that fell back because a provider failed or was shedding load
+        "degraded": [],
+        "citations": [],
+        "plan": None,
+        "actions": [],
+        "tool_results": None,
+        "response": None,
+    }
 
     # safety (deterministically for now)
+    t_stage = time.perf_counter()
     det = deterministic_safety_check(message)
     trace["safety"]["deterministic"] = det
     domain = det["domain"]
+    t_stage = mark(turn, "safety", t_stage)
 
     if det["blocked"]:
         route = "refuse_unsafe"
@@ -99,20 +219,17 @@ def chat(req: ChatRequest):
             f"I can help you with a different question, or feel free to contact our support team. " \
         )
 
+        count_turn("blocked")
         telemetry = {
             "latency_ms": int((time.time() - t0) * 1000),
             "route": route,
             "blocked": True,
+            "answered_by": "blocked",
+            "generated": False,
         }
 
-        return ChatResponse(
-            request_id=request_id,
-            route=route,
-            answer=answer,
-            citations=[],
-            telemetry=telemetry,
-            trace=trace
-        )
+        turn["response"] = respond(turn, route, answer, [], telemetry)
+        return turn
     
     # LLM-A safety classifier goes here. hard code skip for now
     trace["safety"]["llm_classifier"] = {"skipped": True, "reason": "demo_v0.4"}
@@ -129,45 +246,97 @@ def chat(req: ChatRequest):
         trace["routing"]["llm_plan"] = plan.model_dump()
     except Exception as e:
         trace["routing"]["llm_plan_error"] = str(e)
+        turn["degraded"].append("router")
         plan = None
-    
+    t_stage = mark(turn, "routing", t_stage)
+
+    turn["plan"] = plan
+    if plan is None:
+        return turn
+
+    route = plan.mode
+    trace["routing"]["mode"] = route
+
+    actions = list(plan.actions or [])
+
+    if not actions:
+        if route in ("direct_answer", "rag", "tool" "clarify"):
+            actions = [route]
+        else:
+            actions = ["rag"] if plan.rag_query or plan.rag_collections else ["direct_answer"]
+
+    trace["routing"]["actions"] = actions
+    turn["actions"] = actions
+
+    if "tool" in actions:
+        tool_results = run_tools(plan.tool_calls)
+        trace["execution"]["tool"] =  tool_results
+        turn["tool_results"] = tool_results
+
+        for cit in tool_results.get("calls", []):
+            turn["citations"].append({"type": "tool", "name": cit["name"], "args": cit["args"]})
+        mark(turn, "tools", t_stage)
+
+    return turn
+
+def rag_request(turn: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The retrieval this turn still needs, or None."""
+    plan = turn["plan"]
+    if turn["response"] is not None or plan is None or "rag" not in turn["actions"]:
+        return None
+    return {"query": plan.rag_query or turn["message"], "collections": plan.rag_collections}
+
+def finish_turn(turn: Dict[str, Any], rag_result: Optional[Dict[str, Any]] = None) -> ChatResponse:
+    """
+    Second half of a turn: retrieval (unless rag_result was fetched already), answer, history.
+    """
+    if turn["response"] is not None:
+        return turn["response"]
+
+    trace = turn["trace"]
+    message = turn["message"]
+    plan = turn["plan"]
+    actions = turn["actions"]
+    tool_results = turn["tool_results"]
+    citations = turn["citations"]
+    degraded = turn["degraded"]
+
     if plan is None:
         route = "direct_answer"
         answer = f"(Demo) Router failed, fallback to direct. You said: {message}"
         trace["execution"] = {"performed": "direct_answer_fallback"}
+        answered_by = "fallback"
     else:
         route = plan.mode
-        trace["routing"]["mode"] = route
-
-        actions = list(plan.actions or [])
-
-        if not actions:
-            if route in ("direct_answer", "rag", "tool" "clarify"):
-                actions = [route]
-            else:
-                actions = ["rag"] if plan.rag_query or plan.rag_collections else ["direct_answer"]
-
-        trace["routing"]["actions"] = actions
-
-        tool_results = None
-        rag_result = None
 
         clarify_q = plan.clarifying_question if "clarify" in actions else None
 
-        if "tool" in actions:
-            tool_results = run_tools(plan.tool_calls)
-            trace["execution"]["tool"] =  tool_results
-
-            for cit in tool_results.get("calls", []):
-                citations.append({"type": "tool", "name": cit["name"], "args": cit["args"]})
+        t_stage = time.perf_counter()
+        rag = rag_request(turn)
+        if rag and rag_result is None and "rag_error" not in trace["execution"]:
+            try:
+                rag_result = retrieve(rag["query"], top_k=3, collections=rag["collections"])
+            except Exception as e:
+                trace["execution"]["rag_error"] = str(e)
+                degraded.append("rag")
+        elif rag_result and "query_embedding" in rag_result:
+            # embedded as part of a batch: record it as this turn's embed_query response
+            capture.note(
+                "embed_query",
+                capture.pack_vector(rag_result["query_embedding"]),
+                rag_result.get("embed_latency_ms", 0),
+            )
+        if rag:
+            t_stage = mark(turn, "rag", t_stage)
 
-        if "rag" in actions:
-            rag_result = retrieve(plan.rag_query or message, top_k=3)
+        if rag_result:
             trace["execution"]["rag"] = {
                 "query": rag_result["query"],
                 "top_k": rag_result["top_k"],
+                "collections": rag_result["collections"],
+                "candidates": rag_result["candidates"],
                 "hits": [
-                    {"score": hit["score"], "doc_id": hit["doc_id"], "chunk_id": hit["chunk_id"]} 
+                    {"score": hit["score"], "doc_id": hit["doc_id"], "chunk_id": hit["chunk_id"], "chunk_ids": hit["chunk_ids"], "collection": hit["collection"], "tokens": hit["tokens"]} 
                     for hit in rag_result["hits"]
                 ],
             }
@@ -177,33 +346,210 @@ def chat(req: ChatRequest):
                 for hit in rag_result["hits"]
             ])
 
-        answer = synthesize_with_llm_b(
-            user_message=message,
-            actions=[str(action) for action in actions],
-            history=history,
-            rag_hits=rag_result["hits"] if rag_result else None,
-            tool_results=tool_results,
-            clarifying_question=clarify_q,
-        )
+        history = get_history(turn["session_id"])
+        turn["history"] = list(history)
+
+        # confident pure lookups are answered from templates, no LLM-B call
+        skip_reason = template_skip_reason(plan, [str(action) for action in actions], tool_results)
+        if skip_reason is None:
+            answer = tool_answer_from_results(tool_results)
+            answered_by = "templated"
+        else:
+            trace["execution"]["template_skipped"] = skip_reason
+            try:
+                answer = synthesize_with_llm_b(
+                    user_message=message,
+                    actions=[str(action) for action in actions],
+                    history=history,
+                    rag_hits=rag_result["hits"] if rag_result else None,
+                    tool_results=tool_results,
+                    clarifying_question=clarify_q,
+                )
+                answered_by = "generated"
+            except Exception as e:
+                trace["execution"]["synthesis_error"] = str(e)
+                degraded.append("synthesis")
+                answer = fallback_answer(tool_results)
+                answered_by = "fallback"
+        trace["execution"]["answered_by"] = answered_by
+        mark(turn, "answer", t_stage)
 
         history.append({"role": "user", "content": message})
         history.append({"role": "assistant", "content": answer})
 
         # Keep last N turns (prevent token blowup)
-        CONVERSATIONS[session_id] = history[-10:]
+        save_history(turn["session_id"], history)
 
         trace["execution"]["performed"] = route
 
+    trace["coalesced"] = turn["coalesced"]
+    trace["degraded"] = degraded
+    count_turn(answered_by)
+
     telemetry = {
-        "latency_ms": int((time.time() - t0) * 1000),
+        "latency_ms": int((time.time() - turn["t0"]) * 1000),
         "route": route,
-        "blocked": False
+        "blocked": False,
+        "coalesced": bool(turn["coalesced"]),
+        "degraded": bool(degraded),
+        "answered_by": answered_by,
+        "generated": answered_by == "generated",
     }
-    return ChatResponse(
-        request_id=request_id,
-        route=route,
-        answer=answer,
-        citations=citations,
-        telemetry=telemetry,
-        trace=trace
-    )
\ No newline at end of file
+    return respond(turn, route, answer, citations, telemetry)
+
+@app.post("/chat", response_model=ChatResponse)
+def chat(req: ChatRequest):
+    return finish_turn(prepare_turn(req))
+
+def dedupe_key(req: ChatRequest) -> str:
+    # identical question asked with identical context and history gets one pipeline run
+    return json.dumps({
+        "message": (req.message or "").strip(),
+        "conversation_summary": req.conversation_summary,
+        "user_profile": req.user_profile,
+        "ecu_context": req.ecu_context,
+        "attachments": req.attachments,
+        "history": get_history(req.session_id),
+    }, sort_keys=True, default=str)
+
+def copy_for_duplicate(resp: ChatResponse, req: ChatRequest, leader: Optional[Dict[str, Any]] = None) -> ChatResponse:
+    dup = resp.model_copy(deep=True)
+    dup.request_id = str(uuid.uuid4())
+    dup.telemetry["deduplicated"] = True
+
+    # captured as its own turn with the leader's upstream responses, so replay sees the same traffic
+    if leader is not None:
+        duplicate = {**leader, "request_id": dup.request_id, "request": req.model_dump()}
+        capture.record(duplicate, resp.route, resp.answer, dup.telemetry)
+
+    # the duplicate's session still gets the turn in its history
+    history = get_history(req.session_id)
+    history.append({"role": "user", "content": (req.message or "").strip()})
+    history.append({"role": "assistant", "content": resp.answer})
+    save_history(req.session_id, history)
+    return dup
+
+def run_batch(batch: BatchChatRequest) -> Iterator[str]:
+    """
+    Yields one NDJSON line per item as it completes:
+      1. dedupe identical items
+      2. safety, routing and tools for the unique items (bounded concurrency);
+         turns that need no retrieval go straight on to the answer stage
+      3. one embeddings call + one scoring pass per shard for every RAG query in the batch
+      4. retrieval results handed to the answer stage (bounded concurrency)
+    Items sharing a session_id build on each other's history, so they skip the steps above
+    and run as whole turns one after another, in request order.
+    An item that fails gets an {"index", "error"} line; the rest of the batch carries on.
+    """
+    sessions: Dict[str, List[int]] = {}
+    for i, req in enumerate(batch.items):
+        sessions.setdefault(req.session_id, []).append(i)
+    # next item to run once this one is done, for sessions with several items
+    serial_next: Dict[int, Optional[int]] = {}
+    for indices in sessions.values():
+        if len(indices) > 1:
+            serial_next.update(zip(indices, indices[1:] + [None]))
+
+    leaders: Dict[str, int] = {}
+    followers: Dict[int, List[int]] = {}
+    for i, req in enumerate(batch.items):
+        if i in serial_next:
+            continue
+        # every other item is alone in its session, so its history can't change during the batch
+        key = dedupe_key(req)
+        if key in leaders:
+            followers.setdefault(leaders[key], []).append(i)
+        else:
+            leaders[key] = i
+            followers[i] = []
+
+    def emit(i: int, resp: ChatResponse) -> Iterator[str]:
+        yield json.dumps({"index": i, "response": resp.model_dump()}) + "\n"
+        for j in followers.get(i, []):
+            dup = copy_for_duplicate(resp, batch.items[j], turns.get(i))
+            yield json.dumps({"index": j, "deduplicated_from": i, "response": dup.model_dump()}) + "\n"
+
+    def emit_error(i: int, error: Exception) -> Iterator[str]:
+        message = str(error) or type(error).__name__
+        yield json.dumps({"index": i, "error": message}) + "\n"
+        for j in followers.get(i, []):
+            yield json.dumps({"index": j, "deduplicated_from": i, "error": message}) + "\n"
+
+    # every item keeps its own context (deadline, coalescing log) across both stages and threads
+    contexts = {i: contextvars.copy_context() for i in range(len(batch.items))}
+    turns: Dict[int, Dict[str, Any]] = {}
+    rag_requests: Dict[int, Dict[str, Any]] = {}
+
+    def retrieve_batch() -> Dict[int, Dict[str, Any]]:
+        pending = list(rag_requests)
+        requests = [(rag_requests[i]["query"], rag_requests[i]["collections"]) for i in pending]
+        return dict(zip(pending, retrieve_many(requests, top_k=3)))
+
+    def finish(i: int, rag_result: Optional[Dict[str, Any]]) -> ChatResponse:
+        # the answer stage gets a fresh deadline: this item may have waited for the whole batch
+        set_deadline(turns[i]["deadline_s"])
+        return finish_turn(turns[i], rag_result)
+
+    def run_turn(i: int) -> ChatResponse:
+        return finish_turn(prepare_turn(batch.items[i], "batch"))
+
+    with ThreadPoolExecutor(max_workers=batch.max_concurrency) as pool:
+        running: Dict[Future, Tuple[str, int]] = {
+            pool.submit(contexts[i].run, prepare_turn, batch.items[i], "batch"): ("prepare", i) for i in followers
+        }
+        preparing = len(running)
+        retrieving = False
+        for indices in sessions.values():
+            if len(indices) > 1:
+                running[pool.submit(contexts[indices[0]].run, run_turn, indices[0])] = ("serial", indices[0])
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, i = running.pop(future)
+                if stage == "prepare":
+                    preparing -= 1
+                if stage == "serial" and serial_next[i] is not None:
+                    j = serial_next[i]
+                    running[pool.submit(contexts[j].run, run_turn, j)] = ("serial", j)
+
+                if stage == "retrieve":
+                    try:
+                        rag_results = future.result()
+                    except Exception as e:
+                        rag_results = {}
+                        for j in rag_requests:
+                            turns[j]["trace"]["execution"]["rag_error"] = str(e)
+                            turns[j]["degraded"].append("rag")
+                    for j in rag_requests:
+                        running[pool.submit(contexts[j].run, finish, j, rag_results.get(j))] = ("finish", j)
+                    continue
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    yield from emit_error(i, e)
+                    continue
+
+                if stage in ("finish", "serial"):
+                    yield from emit(i, result)
+                    continue
+
+                turns[i] = result
+                if result["response"] is not None:
+                    yield from emit(i, result["response"])
+                else:
+                    rag = rag_request(result)
+                    if rag:
+                        rag_requests[i] = rag
+                    else:
+                        running[pool.submit(contexts[i].run, finish, i, None)] = ("finish", i)
+
+            if not preparing and rag_requests and not retrieving:
+                retrieving = True
+                running[pool.submit(retrieve_batch)] = ("retrieve", -1)
+
+@app.post("/chat/batch")
+def chat_batch(batch: BatchChatRequest):
+    # newline-delimited JSON, one {"index", "response"} object per item in completion order
+    return StreamingResponse(run_batch(batch), media_type="application/x-ndjson")
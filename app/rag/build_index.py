@@ -1,54 +1,234 @@
 import os
+import re
+import sys
 import json
-import math
+import argparse
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple
 
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from app.rag.tokens import count_tokens
+
 load_dotenv()
 client = OpenAI(api_key=os.getenv("OPEN_API_KEY"))
 
 DOCS_DIR = Path(__file__).resolve().parent / "docs"
-OUT_PATH = Path(__file__).resolve().parent / "index.jsonl"
+INDEX_DIR = Path(os.getenv("RAG_INDEX_DIR", Path(__file__).resolve().parent / "index"))
 
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+EMBED_BATCH = int(os.getenv("RAG_EMBED_BATCH", "64"))
+
+# structure-aware chunking: units of the same section (Q&A pair, forum thread, heading)
+# are packed together up to this many tokens and never split unless a single unit is too big
+CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "350"))
+
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+_BLANK_LINE_RE = re.compile(r"\n[ \t]*\n")
+_FORUM_POST_RE = re.compile(r"^Posted .*-\s*$", re.MULTILINE)
+_FORUM_THREAD_RE = re.compile(r"^-{5,}\s*$", re.MULTILINE)
+_MD_HEADING_RE = re.compile(r"^#{1,6}\s+(.+?)\s*#*\s*$", re.MULTILINE)
+
+# a unit is a (title, start_char, end_char) span into the document text
+Unit = Tuple[str, int, int]
+
+def source_type_for(path: Path) -> str:
+    name = path.stem.lower()
+    if "faq" in name:
+        return "faq"
+    if "forum" in name:
+        return "forum"
+    return "doc"
 
-# simple chunking
-CHUNK_CHARS = int(os.getenv("RAG_CHUNK_CHARS", "1200"))
-CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "200"))
+def collection_for(path: Path) -> str:
+    # docs/<collection>/... for subfolders (e.g. docs/manuals/*.md), else the file stem (faqs, forum)
+    rel = path.relative_to(DOCS_DIR)
+    if len(rel.parts) > 1:
+        return rel.parts[0].lower()
+    return path.stem.lower()
 
-def read_text_files() -> List[Dict[str, Any]]:
-    docs = []
-    for pattern in DOCS_DIR.rglob("*"):
+def shard_path(collection: str) -> Path:
+    return INDEX_DIR / f"{collection}.jsonl"
+
+def iter_doc_paths() -> Iterator[Path]:
+    for pattern in sorted(DOCS_DIR.rglob("*")):
         if pattern.is_file() and pattern.suffix.lower() in [".md", ".txt"]:
-            text = pattern.read_text(encoding="utf-8", errors="ignore")
-            docs.append({"doc_id": pattern.name, "path": str(pattern), "text": text})
-    return docs
-
-def chunk_text(text: str, chunk_chars: int, overlap: int) -> List[Dict[str, Any]]:
-    chunks = []
-    n = len(text)
-    start = 0
+            yield pattern
+
+def list_collections() -> List[str]:
+    return sorted({collection_for(path) for path in iter_doc_paths()})
+
+def iter_text_files(collection: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    # one document in memory at a time
+    for pattern in iter_doc_paths():
+        name = collection_for(pattern)
+        if collection is not None and name != collection:
+            continue
+        text = pattern.read_text(encoding="utf-8", errors="ignore")
+        yield {
+            "doc_id": pattern.name,
+            "path": str(pattern),
+            "collection": name,
+            "source_type": source_type_for(pattern),
+            "text": text,
+        }
+
+def _trim_span(text: str, start: int, end: int) -> Tuple[int, int]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def _split_on(pattern: re.Pattern, text: str, start: int, end: int, keep_match: bool) -> List[Tuple[int, int]]:
+    """Split text[start:end] at each match; the match opens the next span if keep_match."""
+    spans = []
+    cursor = start
+    for m in pattern.finditer(text, start, end):
+        if m.start() > cursor:
+            spans.append((cursor, m.start()))
+        cursor = m.start() if keep_match else m.end()
+    if cursor < end:
+        spans.append((cursor, end))
+
+    trimmed = []
+    for s, e in spans:
+        s, e = _trim_span(text, s, e)
+        if s < e:
+            trimmed.append((s, e))
+    return trimmed
+
+def split_faq(text: str) -> List[Unit]:
+    # blocks are separated by blank lines: first line is the question, rest is the answer.
+    # a leading single-line block is the page header (e.g. "FAQs"); any other single-line
+    # block is a question whose answer starts after a blank line, so it opens the next unit
+    units = []
+    question: Optional[Unit] = None
+    for n, (s, e) in enumerate(_split_on(_BLANK_LINE_RE, text, 0, len(text), keep_match=False)):
+        single_line = "\n" not in text[s:e]
+        if single_line and n == 0:
+            continue
+        if question is not None:
+            units.append((question[0], question[1], e))
+            question = None
+        elif single_line:
+            question = (text[s:e], s, e)
+        else:
+            units.append((text[s:e].split("\n", 1)[0].strip(), s, e))
+    if question is not None:
+        units.append(question)
+    return units
+
+def split_forum(text: str) -> List[Unit]:
+    # threads are separated by dashed lines, posts start with a "Posted ... -" header.
+    # posts are titled with the opening line of their thread
+    units = []
+    for ts, te in _split_on(_FORUM_THREAD_RE, text, 0, len(text), keep_match=False):
+        posts = _split_on(_FORUM_POST_RE, text, ts, te, keep_match=True)
+        if not posts:
+            continue
+        opener = text[posts[0][0]:posts[0][1]].split("\n")
+        body = opener[1] if len(opener) > 1 else opener[0]
+        title = _SENTENCE_END_RE.split(body.strip(), 1)[0][:80]
+        units.extend((title, s, e) for s, e in posts)
+    return units
+
+def split_markdown(text: str, default_title: str) -> List[Unit]:
+    # heading sections, further split into paragraphs
+    units = []
+    sections = _split_on(_MD_HEADING_RE, text, 0, len(text), keep_match=True)
+    for s, e in sections:
+        heading = _MD_HEADING_RE.match(text, s)
+        title = heading.group(1) if heading else default_title
+        for ps, pe in _split_on(_BLANK_LINE_RE, text, s, e, keep_match=False):
+            units.append((title, ps, pe))
+    return units
+
+def split_sentences(text: str, unit: Unit, max_tokens: int) -> List[Unit]:
+    """Break one oversized unit into sentence-aligned pieces under max_tokens."""
+    title, start, end = unit
+    sentences = _split_on(_SENTENCE_END_RE, text, start, end, keep_match=False)
+
+    pieces = []
+    piece_start = None
+    piece_end = None
+    for s, e in sentences:
+        if piece_start is not None and count_tokens(text[piece_start:e]) > max_tokens:
+            pieces.append((title, piece_start, piece_end))
+            piece_start = None
+        if piece_start is None:
+            piece_start = s
+        piece_end = e
+    if piece_start is not None:
+        pieces.append((title, piece_start, piece_end))
+    return pieces
+
+def split_units(doc: Dict[str, Any]) -> List[Unit]:
+    text = doc["text"]
+    source_type = doc["source_type"]
+    if source_type == "faq":
+        return split_faq(text)
+    if source_type == "forum":
+        return split_forum(text)
+    return split_markdown(text, default_title=Path(doc["doc_id"]).stem)
+
+def chunk_document(doc: Dict[str, Any], max_tokens: int = CHUNK_TOKENS) -> Iterator[Dict[str, Any]]:
+    """
+    Packs consecutive structural units of the same section into chunks of at most
+    max_tokens, so a chunk never spans two Q&As, threads or headings.
+    Chunks never overlap and start_char/end_char index into the original text.
+    """
+    text = doc["text"]
+
+    units: List[Unit] = []
+    for unit in split_units(doc):
+        if count_tokens(text[unit[1]:unit[2]]) > max_tokens:
+            units.extend(split_sentences(text, unit, max_tokens))
+        else:
+            units.append(unit)
+
     index = 0
-    while start < n:
-        end = min(n, start + chunk_chars)
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append({
-                "chunk_id": index,
-                "start_char": start,
-                "end_char": end,
-                "text": chunk
-            })
+    pending: List[Unit] = []
+
+    def flush() -> Dict[str, Any]:
+        start, end = pending[0][1], pending[-1][2]
+        return {
+            "chunk_id": index,
+            "start_char": start,
+            "end_char": end,
+            "section_title": pending[0][0],
+            "source_type": doc["source_type"],
+            "text": text[start:end],
+        }
+
+    for unit in units:
+        if pending and (unit[0] != pending[0][0] or count_tokens(text[pending[0][1]:unit[2]]) > max_tokens):
+            yield flush()
             index += 1
-        start = end - overlap
-        if start < 0:
-            start = 0
-        if end == n:
-            break
-    return chunks
+            pending = []
+        pending.append(unit)
+    if pending:
+        yield flush()
+
+def iter_chunks(docs: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    for doc in docs:
+        for chunk in chunk_document(doc):
+            yield {
+                "doc_id": doc["doc_id"],
+                "path": doc["path"],
+                "collection": doc["collection"],
+                **chunk,
+            }
+
+def batched(rows: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    it = iter(rows)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
 
 def embed_texts(texts: List[str]) -> List[List[float]]:
     # openai embeddings API: batch inputs
@@ -58,37 +238,60 @@ def embed_texts(texts: List[str]) -> List[List[float]]:
     )
     return [d.embedding for d in resp.data]
 
-def main():
-    docs = read_text_files()
-    if not docs:
+def write_index(rows: Iterable[Dict[str, Any]], out_path: Path, batch_size: int = EMBED_BATCH) -> int:
+    # embed and write batch by batch; the old index is only replaced once the new one is complete
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_suffix(out_path.suffix + ".tmp")
+
+    written = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for batch in batched(rows, batch_size):
+            embeddings = embed_texts([row["text"] for row in batch])
+            for row, embed in zip(batch, embeddings):
+                row["embedding"] = embed
+                f.write(json.dumps(row) + "\n")
+            written += len(batch)
+
+    if not written:
+        # nothing left to index: a stale shard would keep serving the old chunks
+        tmp_path.unlink()
+        out_path.unlink(missing_ok=True)
+        return 0
+    tmp_path.replace(out_path)
+    return written
+
+def build_collection(collection: str) -> int:
+    return write_index(iter_chunks(iter_text_files(collection)), shard_path(collection))
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Build per-collection RAG index shards.")
+    parser.add_argument(
+        "collections",
+        nargs="*",
+        help="collections to rebuild (default: all). Collections are top-level files or folders in docs/",
+    )
+    args = parser.parse_args(argv)
+
+    available = list_collections()
+    if not available:
         raise RuntimeError(f"No docs found in {DOCS_DIR}. Add .md or .txt files first.")
-    
-    rows = []
-    for doc in docs:
-        chunks = chunk_text(doc["text"], CHUNK_CHARS, CHUNK_OVERLAP)
-        for chunk in chunks:
-            rows.append({
-                "doc_id": doc["doc_id"],
-                "path": doc["path"],
-                "chunk_id": chunk["chunk_id"],
-                "start_char": chunk["start_char"],
-                "end_char": chunk["end_char"],
-                "text": chunk["text"]
-            })
-    
-    # embed
-    embeddings = embed_texts([row["text"] for row in rows])
-    for row, embed in zip(rows, embeddings):
-        row["embedding"] = embed
-
-    # save JSONL
-    OUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with open(OUT_PATH, "w", encoding="utf-8") as f:
-        for row in rows:
-            f.write(json.dumps(row) + "\n")
-
-    print(f"Wrote {len(rows)} chunks to {OUT_PATH}")
 
-if __name__ == "__main__":
-    main()
+    unknown = [c for c in args.collections if c not in available]
+    if unknown:
+        raise RuntimeError(f"Unknown collection(s): {unknown}. Available: {available}")
+
+    for collection in args.collections or available:
+        written = build_collection(collection)
+        if written:
+            print(f"Wrote {written} chunks to {shard_path(collection)}")
+        else:
+            print(f"No chunks for '{collection}', removed {shard_path(collection)}")
 
+    # shards whose docs were deleted would otherwise still be searched
+    for path in sorted(INDEX_DIR.glob("*.jsonl")):
+        if path.stem not in available:
+            path.unlink()
+            print(f"Removed {path}: no docs left for collection '{path.stem}'")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
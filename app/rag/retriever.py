@@ -1,19 +1,37 @@
 import os
 import json
 import math
+import heapq
+import time
+from array import array
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from app.rag.tokens import count_tokens
+from app.runtime.singleflight import coalesce
+from app.runtime.resilience import guard
+from app.runtime import capture
+
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# retries are handled by the provider guard, not the SDK
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
-INDEX_PATH = Path(__file__).resolve().parent / "index.jsonl"
+INDEX_DIR = Path(os.getenv("RAG_INDEX_DIR", Path(__file__).resolve().parent / "index"))
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
 
-def cosine(a: List[float], b: List[float]) -> float:
+# reranking: fetch a wider candidate set, merge neighbouring chunks, then pick diverse hits
+RAG_CANDIDATE_K = int(os.getenv("RAG_CANDIDATE_K", "12"))
+# 1.0 = pure relevance, lower values penalise hits similar to ones already picked
+RAG_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+# total approximate tokens of hit text handed to LLM-B
+RAG_TOKEN_BUDGET = int(os.getenv("RAG_TOKEN_BUDGET", "1200"))
+# chunks of the same doc and section this close together (chars) are merged into one passage
+RAG_MERGE_GAP_CHARS = int(os.getenv("RAG_MERGE_GAP_CHARS", "2"))
+
+def cosine(a: Sequence[float], b: Sequence[float]) -> float:
     dot = 0.0
     na= 0.0
     nb = 0.0
@@ -25,48 +43,258 @@ def cosine(a: List[float], b: List[float]) -> float:
         return 0.0
     return dot / (math.sqrt(na) * math.sqrt(nb))
 
-def load_index() -> List[Dict[str, Any]]:
-    if not INDEX_PATH.exists():
-        raise RuntimeError(f"RAG index not found at {INDEX_PATH}. Run build_index.py first.")
+# collection -> (shard mtime, rows). Shards are reloaded only when build_index rewrites them
+_SHARDS: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+
+def list_collections() -> List[str]:
+    if not INDEX_DIR.exists():
+        return []
+    return sorted(path.stem for path in INDEX_DIR.glob("*.jsonl"))
+
+def load_shard(collection: str) -> List[Dict[str, Any]]:
+    path = INDEX_DIR / f"{collection}.jsonl"
+    if not path.exists():
+        raise RuntimeError(f"RAG shard '{collection}' not found at {path}. Run build_index.py first.")
+
+    mtime = path.stat().st_mtime
+    cached = _SHARDS.get(collection)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
     rows = []
-    with open(INDEX_PATH, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         for line in f:
-            rows.append(json.loads(line))
+            row = json.loads(line)
+            # packed float32 instead of a list of float objects: ~6x smaller, and pages
+            # stay shared copy-on-write between forked workers (no per-float refcounts)
+            row["embedding"] = array("f", row["embedding"])
+            rows.append(row)
+    _SHARDS[collection] = (mtime, rows)
     return rows
 
+def preload() -> Dict[str, int]:
+    """Loads every shard now; returns chunk counts per collection."""
+    return {collection: len(load_shard(collection)) for collection in list_collections()}
+
+def resolve_collections(requested: Optional[Iterable[str]]) -> List[str]:
+    """
+    Maps the router's rag_collections onto the shards on disk.
+    Unknown names are ignored; nothing usable selected means search everything.
+    """
+    available = list_collections()
+    if not available:
+        raise RuntimeError(f"RAG index not found in {INDEX_DIR}. Run build_index.py first.")
+
+    selected = []
+    for name in requested or []:
+        name = str(name).strip().lower()
+        if name in available and name not in selected:
+            selected.append(name)
+    return selected or available
+
 def embed_query(q: str) -> List[float]:
-    resp = client.embeddings.create(
-        model=EMBED_MODEL,
-        input=[q]
+    def call(timeout: float) -> List[float]:
+        resp = client.embeddings.create(
+            model=EMBED_MODEL,
+            input=[q],
+            timeout=timeout,
+        )
+        return resp.data[0].embedding
+
+    return capture.upstream(
+        "embed_query",
+        lambda: coalesce(
+            "embed_query",
+            {"model": EMBED_MODEL, "input": q},
+            lambda: guard("openai").call(call),
+            provider="openai",
+        ),
+        encode=capture.pack_vector,
+        decode=capture.unpack_vector,
     )
-    return resp.data[0].embedding
 
-def retrieve(q: str, top_k: int = 3) -> Dict[str, Any]:
-    rows = load_index()
-    q_embed = embed_query(q)
+def embed_queries(qs: List[str]) -> List[List[float]]:
+    """One embeddings request for many queries (batch workloads)."""
+    def call(timeout: float) -> List[List[float]]:
+        resp = client.embeddings.create(
+            model=EMBED_MODEL,
+            input=qs,
+            timeout=timeout,
+        )
+        return [d.embedding for d in resp.data]
+
+    return coalesce(
+        "embed_queries",
+        {"model": EMBED_MODEL, "input": qs},
+        lambda: guard("openai").call(call),
+        provider="openai",
+    )
+
+def search_shard(q_embed: List[float], collection: str, top_k: int) -> List[Tuple[float, Dict[str, Any]]]:
+    scored = ((cosine(q_embed, row["embedding"]), row) for row in load_shard(collection))
+    return heapq.nlargest(top_k, scored, key=lambda x: x[0])
 
-    scored: List[Tuple[float, Dict[str, Any]]] = []
-    for row in rows:
-        score = cosine(q_embed, row["embedding"])
-        scored.append((score, row))
+def search_shard_many(q_embeds: List[Sequence[float]], collection: str, top_k: int) -> List[List[Tuple[float, Dict[str, Any]]]]:
+    """
+    Scores every query against a shard in a single pass over its rows (a query x chunk
+    similarity matrix, one row norm per chunk), keeping a running top-k per query.
+    """
+    q_norms = [math.sqrt(sum(x * x for x in q)) for q in q_embeds]
+    tops: List[List[Tuple[float, int, Dict[str, Any]]]] = [[] for _ in q_embeds]
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top = scored[:top_k]
+    for position, row in enumerate(load_shard(collection)):
+        emb = row["embedding"]
+        row_norm = math.sqrt(sum(x * x for x in emb))
+        for qi, q in enumerate(q_embeds):
+            if row_norm == 0.0 or q_norms[qi] == 0.0:
+                score = 0.0
+            else:
+                score = sum(x * y for x, y in zip(q, emb)) / (q_norms[qi] * row_norm)
+            # position breaks ties so rows (dicts) are never compared
+            entry = (score, position, row)
+            if len(tops[qi]) < top_k:
+                heapq.heappush(tops[qi], entry)
+            elif score > tops[qi][0][0]:
+                heapq.heapreplace(tops[qi], entry)
+
+    return [[(score, row) for score, _, row in sorted(top, key=lambda x: x[0], reverse=True)] for top in tops]
+
+def merge_adjacent(candidates: List[Tuple[float, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Collapses overlapping or adjacent chunks of the same document section into one passage
+    (a section only spans several chunks when it was too big for one). Neighbouring chunks of
+    different sections, e.g. two FAQ answers, stay separate hits.
+    The passage keeps the best score, the union of offsets and the summed embedding.
+    """
+    by_doc: Dict[Tuple[Any, Any], List[Tuple[float, Dict[str, Any]]]] = {}
+    for score, row in candidates:
+        by_doc.setdefault((row.get("collection"), row["doc_id"]), []).append((score, row))
+
+    passages = []
+    for group in by_doc.values():
+        group.sort(key=lambda x: x[1]["start_char"])
+        current: Optional[Dict[str, Any]] = None
+        for score, row in group:
+            if (
+                current is not None
+                and row.get("section_title") == current["row"].get("section_title")
+                and row["start_char"] <= current["end_char"] + RAG_MERGE_GAP_CHARS
+            ):
+                overlap = current["end_char"] - row["start_char"]
+                if overlap > 0:
+                    # offsets are approximate for stripped chunks, so never cut more than the text
+                    current["text"] += row["text"][min(overlap, len(row["text"])):]
+                else:
+                    current["text"] += "\n\n" + row["text"]
+                current["end_char"] = max(current["end_char"], row["end_char"])
+                current["score"] = max(current["score"], score)
+                current["chunk_ids"].append(row["chunk_id"])
+                current["embedding"] = array("f", (x + y for x, y in zip(current["embedding"], row["embedding"])))
+                continue
+
+            current = {
+                "score": score,
+                "row": row,
+                "chunk_ids": [row["chunk_id"]],
+                "start_char": row["start_char"],
+                "end_char": row["end_char"],
+                "text": row["text"],
+                "embedding": row["embedding"],
+            }
+            passages.append(current)
+    return passages
+
+def rerank(candidates: List[Tuple[float, Dict[str, Any]]], top_k: int, token_budget: int = RAG_TOKEN_BUDGET) -> List[Dict[str, Any]]:
+    """
+    Merges neighbouring chunks, then picks up to top_k passages by maximal marginal
+    relevance within token_budget. The best passage is always kept, even if over budget.
+    """
+    pool = merge_adjacent(candidates)
+    for passage in pool:
+        passage["tokens"] = count_tokens(passage["text"])
+
+    selected: List[Dict[str, Any]] = []
+    used = 0
+    while pool and len(selected) < top_k:
+        def mmr(passage: Dict[str, Any]) -> float:
+            redundancy = max((cosine(passage["embedding"], s["embedding"]) for s in selected), default=0.0)
+            return RAG_MMR_LAMBDA * passage["score"] - (1 - RAG_MMR_LAMBDA) * redundancy
+
+        best = max(pool, key=mmr)
+        pool.remove(best)
+        if selected and used + best["tokens"] > token_budget:
+            continue
+        selected.append(best)
+        used += best["tokens"]
+    return selected
+
+def to_result(q: str, top_k: int, selected: List[str], candidates: List[Tuple[float, Dict[str, Any]]]) -> Dict[str, Any]:
+    passages = rerank(candidates, top_k)
 
     hits = []
-    for score, row in top:
+    for passage in passages:
+        row = passage["row"]
         hits.append({
-            "score": score,
+            "score": passage["score"],
             "doc_id": row["doc_id"],
             "path": row["path"],
-            "chunk_id": row["chunk_id"],
-            "start_char": row["start_char"],
-            "end_char": row["end_char"],
-            "text": row["text"]
+            "collection": row.get("collection"),
+            "section_title": row.get("section_title"),
+            "source_type": row.get("source_type"),
+            "chunk_id": passage["chunk_ids"][0],
+            "chunk_ids": passage["chunk_ids"],
+            "start_char": passage["start_char"],
+            "end_char": passage["end_char"],
+            "tokens": passage["tokens"],
+            "text": passage["text"]
         })
     
     return {
         "query": q,
         "top_k": top_k,
+        "collections": selected,
+        "candidates": len(candidates),
         "hits": hits
-    }
\ No newline at end of file
+    }
+
+def retrieve(q: str, top_k: int = 3, collections: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    selected = resolve_collections(collections)
+    q_embed = embed_query(q)
+
+    # per-shard top candidates, merged: the global top candidates are always within the union
+    candidates: List[Tuple[float, Dict[str, Any]]] = []
+    for collection in selected:
+        candidates.extend(search_shard(q_embed, collection, RAG_CANDIDATE_K))
+    candidates = heapq.nlargest(RAG_CANDIDATE_K, candidates, key=lambda x: x[0])
+    return to_result(q, top_k, selected, candidates)
+
+def retrieve_many(requests: List[Tuple[str, Optional[Iterable[str]]]], top_k: int = 3) -> List[Dict[str, Any]]:
+    """
+    retrieve() for many (query, collections) pairs at once: one embeddings call for the
+    distinct queries, and one scoring pass per shard covering every query that selected it.
+    """
+    selected = [resolve_collections(collections) for _, collections in requests]
+    distinct = list(dict.fromkeys(q for q, _ in requests))
+    if not distinct:
+        return []
+    t0 = time.perf_counter()
+    embeds = dict(zip(distinct, embed_queries(distinct)))
+    # the shared embeddings call, split evenly across the queries it served
+    embed_latency_ms = int((time.perf_counter() - t0) * 1000 / len(distinct))
+
+    candidates: List[List[Tuple[float, Dict[str, Any]]]] = [[] for _ in requests]
+    shards = sorted({collection for cols in selected for collection in cols})
+    for collection in shards:
+        members = [i for i, cols in enumerate(selected) if collection in cols]
+        per_query = search_shard_many([embeds[requests[i][0]] for i in members], collection, RAG_CANDIDATE_K)
+        for i, found in zip(members, per_query):
+            candidates[i].extend(found)
+
+    results = []
+    for i, (q, _) in enumerate(requests):
+        result = to_result(q, top_k, selected[i], heapq.nlargest(RAG_CANDIDATE_K, candidates[i], key=lambda x: x[0]))
+        # kept so a captured batch item can still be replayed through embed_query
+        result["query_embedding"] = embeds[q]
+        result["embed_latency_ms"] = embed_latency_ms
+        results.append(result)
+    return results
\ No newline at end of file
@@ -0,0 +1,7 @@
+import re
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+def count_tokens(text: str) -> int:
+    # rough, dependency-free estimate: words and punctuation marks
+    return len(_TOKEN_RE.findall(text))
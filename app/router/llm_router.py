@@ -4,9 +4,14 @@ from typing import Any, Dict, Optional
 from dotenv import load_dotenv
 from openai import OpenAI
 from .schemas import RoutePlan
+from app.runtime.singleflight import coalesce
+from app.runtime.resilience import guard
+from app.runtime import capture
+from app.rag.retriever import list_collections
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# retries are handled by the provider guard, not the SDK
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
 ROUTER_MODEL = os.getenv("ROUTER_MODEL", "gpt-4.1-mini")
 
@@ -34,6 +39,7 @@ ACTIONS (must always be filled):
 
 FIELD RULES:
 - If "rag" in actions: set rag_query (or null to use user message). Prefer short keyword-style query.
+- If "rag" in actions: set rag_collections to the collections worth searching, chosen from: {collections}. Leave it empty to search all collections.
 - If "tool" in actions: populate tool_calls with approved tools and arguments.
 - If "clarify" in actions: populate clarifying_question with ONE concise question.
 
@@ -97,6 +103,21 @@ SAFETY POLICY (MUST BE ADHERED TO AT ALL TIMES):
 - If the user is seeking tuning advice, choose actions that include direct_answer and clarify, with a firm safety stance and recommendation to use a professional tuner.
 """
 
+# what the known collections hold; any other shard in the index is offered by name only
+COLLECTION_DESCRIPTIONS = {
+    "faqs": "official Link FAQs: buying, dealers, unlock codes, software, support",
+    "forum": "Link forum threads: firmware behaviour, bugs, G4+/G5 migration, troubleshooting",
+    "manuals": "product manuals",
+}
+
+def router_system_prompt() -> str:
+    # built per call from the shards on disk, so a rebuilt index is picked up without a restart
+    collections = ", ".join(
+        f"{name} ({COLLECTION_DESCRIPTIONS[name]})" if name in COLLECTION_DESCRIPTIONS else name
+        for name in list_collections()
+    )
+    return ROUTER_SYSTEM_PROMPT.replace("{collections}", collections or "none, the index is not built")
+
 def route_with_llm(
     message: str,
     conversation_summary: Optional[str] = None,
@@ -114,21 +135,36 @@ def route_with_llm(
         "ecu_context_keys": list(ecu_context.keys())
     }
 
-    # structured outputs (JSON) so that the model must comply
-    resp = client.responses.parse(
-        model=ROUTER_MODEL,
-        input=[
-            {"role": "system", "content": ROUTER_SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": "Route this request using the RoutePlan schema:\n"
-                            + json.dumps(user_content, indent=2)
-            }
-        ],
-        text_format=RoutePlan,
-    )
-
-    plan = resp.output_parsed
-    if plan is None:
-        raise ValueError("Router model did not return a valid RoutePlan (output_parsed is None).")
-    return plan
\ No newline at end of file
+    def call(timeout: float) -> RoutePlan:
+        # structured outputs (JSON) so that the model must comply
+        resp = client.responses.parse(
+            model=ROUTER_MODEL,
+            input=[
+                {"role": "system", "content": router_system_prompt()},
+                {
+                    "role": "user",
+                    "content": "Route this request using the RoutePlan schema:\n"
+                                + json.dumps(user_content, indent=2)
+                }
+            ],
+            text_format=RoutePlan,
+            timeout=timeout,
+        )
+
+        plan = resp.output_parsed
+        if plan is None:
+            raise ValueError("Router model did not return a valid RoutePlan (output_parsed is None).")
+        return plan
+
+    # identical concurrent requests share one router call
+    return capture.upstream(
+        "route_with_llm",
+        lambda: coalesce(
+            "route_with_llm",
+            {"model": ROUTER_MODEL, "input": user_content},
+            lambda: guard("openai").call(call),
+            provider="openai",
+        ),
+        encode=lambda plan: plan.model_dump(),
+        decode=RoutePlan.model_validate,
+    )
\ No newline at end of file
@@ -0,0 +1,110 @@
+import os
+import time
+import base64
+from array import array
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Sequence, TypeVar
+
+from app.runtime.tracing import TraceSink
+
+T = TypeVar("T")
+
+# opt-in: every /chat turn, with its upstream responses, is appended here (*.jsonl or *.db)
+CAPTURE_PATH = os.getenv("CAPTURE_PATH")
+
+SINK: Optional[TraceSink] = TraceSink(CAPTURE_PATH) if CAPTURE_PATH else None
+
+class ReplayMiss(RuntimeError):
+    """The replayed session has no recorded response for an upstream call the code made."""
+
+# capture: stage -> list of {"latency_ms", "value"} recorded during this turn
+_recording: ContextVar[Optional[Dict[str, List[Dict[str, Any]]]]] = ContextVar("capture_recording", default=None)
+# replay: recorded responses to hand out instead of calling upstream
+_replay: ContextVar[Optional[Dict[str, Any]]] = ContextVar("capture_replay", default=None)
+
+def pack_vector(vec: Sequence[float]) -> str:
+    # float32 + base64: ~5.3 bytes per dimension instead of ~20 as JSON text
+    return base64.b64encode(array("f", vec).tobytes()).decode("ascii")
+
+def unpack_vector(packed: str) -> List[float]:
+    vec = array("f")
+    vec.frombytes(base64.b64decode(packed))
+    return vec.tolist()
+
+def begin() -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """Starts recording upstream responses for the current turn if capture is on."""
+    if SINK is None or _replay.get() is not None:
+        _recording.set(None)
+        return None
+    recording: Dict[str, List[Dict[str, Any]]] = {}
+    _recording.set(recording)
+    return recording
+
+def note(stage: str, value: Any, latency_ms: int = 0) -> None:
+    """Records an already-encoded upstream value for the current turn (capture only)."""
+    recording = _recording.get()
+    if recording is not None and value is not None:
+        recording.setdefault(stage, []).append({"latency_ms": latency_ms, "value": value})
+
+def start_replay(upstream: Dict[str, List[Dict[str, Any]]], speedup: float) -> Dict[str, Any]:
+    """
+    Serves upstream() calls in the current context from a captured turn.
+    speedup scales the recorded upstream latency (0 = don't wait at all).
+    """
+    session = {
+        "upstream": {stage: list(calls) for stage, calls in upstream.items()},
+        "speedup": speedup,
+        "misses": [],
+    }
+    _replay.set(session)
+    _recording.set(None)
+    return session
+
+def upstream(stage: str, fn: Callable[[], T], encode: Callable[[T], Any], decode: Callable[[Any], T]) -> T:
+    """
+    Wraps one upstream call (embedding, router, LLM-B).
+    Replay: returns the next recorded response for this stage after the scaled recorded latency.
+    Capture: calls fn() and records the encoded result and its latency.
+    """
+    session = _replay.get()
+    if session is not None:
+        calls = session["upstream"].get(stage)
+        if not calls:
+            session["misses"].append(stage)
+            raise ReplayMiss(f"no recorded {stage} response left in this session")
+        call = calls.pop(0)
+        if session["speedup"] > 0:
+            time.sleep(call["latency_ms"] / 1000 / session["speedup"])
+        return decode(call["value"])
+
+    t0 = time.perf_counter()
+    result = fn()
+    note(stage, encode(result), int((time.perf_counter() - t0) * 1000))
+    return result
+
+def record(turn: Dict[str, Any], route: str, answer: str, telemetry: Dict[str, Any]) -> None:
+    if SINK is None or turn.get("upstream") is None:
+        return
+    plan = turn.get("plan")
+    SINK.emit({
+        "request_id": turn["request_id"],
+        "ts": time.time(),
+        "route": route,
+        # "batch" turns waited on the rest of their batch, so their latencies aren't interactive ones
+        "source": turn.get("source", "chat"),
+        "request": turn["request"],
+        "history": turn.get("history"),
+        "plan": plan.model_dump() if plan is not None else None,
+        "tool_results": turn.get("tool_results"),
+        "answer": answer,
+        "stages_ms": turn["stages_ms"],
+        "latency_ms": telemetry.get("latency_ms"),
+        "upstream": turn["upstream"],
+    })
+
+def close() -> None:
+    if SINK is not None:
+        SINK.close()
+
+def sink_stats() -> Optional[Dict[str, Any]]:
+    return SINK.stats() if SINK else None
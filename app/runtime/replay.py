@@ -0,0 +1,173 @@
+"""
+Deterministic replay of captured /chat traffic, for performance regression testing.
+
+Capture (opt-in) while serving:
+
+    CAPTURE_PATH=capture.jsonl uvicorn app.main:app --port 8000
+
+Replay the captured turns through the real pipeline (safety, tools, retrieval,
+reranking, templates, ...) with the recorded router plans, embeddings and LLM-B
+answers injected in place of the upstream calls, so no network is used:
+
+    python -m app.runtime.replay capture.jsonl --speedup 10 --report new.json
+    python -m app.runtime.replay capture.jsonl --speedup 10 --report new.json --baseline old.json
+
+--speedup scales both the recorded upstream latencies and the gaps between requests
+(0 = no waiting at all). Compare reports made at the same speedup: run one on the old
+code version, one on the new, and pass the old report as --baseline.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+def load_sessions(path: str) -> List[Dict[str, Any]]:
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        conn = sqlite3.connect(path)
+        rows = conn.execute("SELECT record FROM traces ORDER BY ts").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r.get("ts", 0))
+    return records
+
+def stats(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"n": 0}
+    values = sorted(values)
+    return {
+        "n": len(values),
+        "mean": round(sum(values) / len(values), 2),
+        "p50": round(values[len(values) // 2], 2),
+        "p95": round(values[max(0, int(len(values) * 0.95) - 1)], 2),
+    }
+
+def replay_turn(record: Dict[str, Any], speedup: float) -> Dict[str, Any]:
+    from app.main import ChatRequest, chat
+    from app.runtime import capture
+    from app.state.conversations import save_history
+
+    # restore the conversation as it was when the turn was captured
+    request = {**record["request"], "trace_level": "off"}
+    save_history(request["session_id"], record.get("history") or [])
+
+    session = capture.start_replay(record.get("upstream") or {}, speedup)
+    resp = chat(ChatRequest(**request))
+    return {
+        "request_id": record["request_id"],
+        "source": record.get("source", "chat"),
+        "latency_ms": resp.telemetry["latency_ms"],
+        "stages_ms": resp.telemetry.get("stages_ms", {}),
+        "misses": session["misses"],
+        "route_matches": resp.route == record.get("route"),
+        "answer_matches": resp.answer == record.get("answer"),
+    }
+
+def run(records: List[Dict[str, Any]], speedup: float, concurrency: int) -> List[Dict[str, Any]]:
+    if not records:
+        return []
+    t_first = records[0].get("ts", 0)
+    t_start = time.monotonic()
+
+    def paced(record: Dict[str, Any]) -> Dict[str, Any]:
+        if speedup > 0:
+            delay = (record.get("ts", t_first) - t_first) / speedup - (time.monotonic() - t_start)
+            if delay > 0:
+                time.sleep(delay)
+        # each turn gets its own context: replay session, deadline, coalescing log
+        return contextvars.copy_context().run(replay_turn, record, speedup)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(paced, records))
+
+def build_report(path: str, speedup: float, records: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # batch turns are replayed (and checked) like any other, but their recorded latencies include
+    # waiting on the rest of the batch, so the latency comparison covers interactive turns only
+    batch_turns = sum(r.get("source") == "batch" for r in results)
+    records = [r for r in records if r.get("source", "chat") != "batch"]
+    timed = [r for r in results if r.get("source", "chat") != "batch"]
+    stages = sorted({stage for r in records + timed for stage in r.get("stages_ms", {})})
+    return {
+        "source": path,
+        "speedup": speedup,
+        "turns": len(results),
+        "batch_turns": batch_turns,
+        "replay_misses": sum(len(r["misses"]) for r in results),
+        "route_mismatches": sum(not r["route_matches"] for r in results),
+        "answer_mismatches": sum(not r["answer_matches"] for r in results),
+        "latency_ms": {
+            "recorded": stats([r["latency_ms"] for r in records if r.get("latency_ms") is not None]),
+            "replayed": stats([r["latency_ms"] for r in timed]),
+        },
+        "stages_ms": {
+            stage: {
+                "recorded": stats([r["stages_ms"][stage] for r in records if stage in r.get("stages_ms", {})]),
+                "replayed": stats([r["stages_ms"][stage] for r in timed if stage in r["stages_ms"]]),
+            }
+            for stage in stages
+        },
+    }
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    print(
+        f"{report['turns']} turns ({report.get('batch_turns', 0)} from batches, not timed) replayed at {report['speedup']}x: "
+        f"{report['replay_misses']} replay misses, {report['route_mismatches']} route mismatches, "
+        f"{report['answer_mismatches']} answer mismatches"
+    )
+    against = "baseline" if baseline else "recorded"
+    print(f"{'stage':<10} {against + ' p50':>14} {'replay p50':>11} {'delta':>9} {'replay p95':>11}")
+
+    rows = [("total", report["latency_ms"], (baseline or {}).get("latency_ms"))]
+    rows += [
+        (stage, entry, (baseline or {}).get("stages_ms", {}).get(stage))
+        for stage, entry in report["stages_ms"].items()
+    ]
+    for stage, entry, base_entry in rows:
+        reference = (base_entry or {}).get("replayed", {}) if baseline else entry["recorded"]
+        replayed = entry["replayed"]
+        if not replayed.get("n"):
+            continue
+        ref_p50 = reference.get("p50")
+        delta = f"{replayed['p50'] - ref_p50:+.1f}" if ref_p50 is not None else "n/a"
+        print(f"{stage:<10} {ref_p50 if ref_p50 is not None else 'n/a':>14} {replayed['p50']:>11} {delta:>9} {replayed['p95']:>11}")
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture log written with CAPTURE_PATH (.jsonl or .db)")
+    parser.add_argument("--speedup", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--report", help="write the JSON report here")
+    parser.add_argument("--baseline", help="report from a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    # replay must never reach a provider or a live conversation store
+    os.environ.setdefault("OPENAI_API_KEY", "replay")
+    os.environ.setdefault("ANTHROPIC_API_KEY", "replay")
+    os.environ.pop("CAPTURE_PATH", None)
+    os.environ.pop("CONVERSATION_DB", None)
+
+    records = load_sessions(args.capture)
+    results = run(records, args.speedup, args.concurrency)
+    report = build_report(args.capture, args.speedup, records, results)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,242 @@
+import os
+import time
+import random
+import threading
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+# SDK exceptions worth retrying, matched by class name so this module doesn't import either SDK
+# (APITimeoutError subclasses APIConnectionError in both openai and anthropic)
+RETRYABLE_ERRORS = {"APIConnectionError", "RateLimitError", "InternalServerError", "OverloadedError"}
+RETRYABLE_STATUS = {408, 409, 429}
+
+# the shortest attempt worth starting; with less time left than this we fail fast instead
+MIN_ATTEMPT_S = 0.25
+
+class ProviderUnavailable(RuntimeError):
+    """Raised instead of calling a provider that is shedding load, tripped, or out of time."""
+    def __init__(self, provider: str, reason: str):
+        super().__init__(f"{provider} unavailable: {reason}")
+        self.provider = provider
+        self.reason = reason
+
+def _env(provider: str, name: str, default: str) -> str:
+    # per-provider override (OPENAI_MAX_CONCURRENCY) falls back to the shared LLM_* setting
+    return os.getenv(f"{provider.upper()}_{name}", os.getenv(f"LLM_{name}", default))
+
+def is_retryable(e: BaseException) -> bool:
+    status = getattr(e, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS or status >= 500
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(e).__mro__)
+
+# ---------------------------------------------------------------------------
+# request deadline, propagated to every upstream call made on behalf of the request
+# ---------------------------------------------------------------------------
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+def set_deadline(seconds: Optional[float]) -> None:
+    _deadline.set(time.monotonic() + seconds if seconds else None)
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+# ---------------------------------------------------------------------------
+
+class CircuitBreaker:
+    """
+    closed -> open after failure_threshold consecutive failures.
+    open -> half_open after reset_after_s; one probe call is let through.
+    half_open -> closed on probe success, back to open on probe failure.
+    """
+    def __init__(self, failure_threshold: int, reset_after_s: float):
+        self.failure_threshold = failure_threshold
+        self.reset_after_s = reset_after_s
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_after_s:
+                self.state = "half_open"
+                self.probing = False
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit: grows by ~1 per limit-worth of calls that finish under the
+    latency target, shrinks multiplicatively on timeouts and failures.
+    Callers beyond the limit queue (bounded); queue overflow or queue timeout is shed.
+    """
+    def __init__(self, initial: int, min_limit: int, max_limit: int, max_queue: int, latency_target_s: float):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.latency_target_s = latency_target_s
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+
+            self.waiting += 1
+            try:
+                ok = self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout=timeout)
+                if ok:
+                    self.in_flight += 1
+                return ok
+            finally:
+                self.waiting -= 1
+
+    def release(self, latency_s: Optional[float], ok: bool) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            if not ok:
+                self.limit = max(float(self.min_limit), self.limit * 0.7)
+            elif latency_s is not None and latency_s <= self.latency_target_s:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+class ProviderGuard:
+    """Concurrency limit, deadline-bounded timeouts, jittered retries and a circuit breaker for one provider."""
+    def __init__(self, name: str, latency_target_s: float):
+        max_limit = int(_env(name, "MAX_CONCURRENCY", "16"))
+        self.name = name
+        self.call_timeout_s = float(_env(name, "CALL_TIMEOUT_S", "30"))
+        self.queue_timeout_s = float(_env(name, "QUEUE_TIMEOUT_S", "2"))
+        self.max_retries = int(_env(name, "MAX_RETRIES", "2"))
+        self.backoff_base_s = float(_env(name, "BACKOFF_BASE_S", "0.2"))
+        self.backoff_cap_s = float(_env(name, "BACKOFF_CAP_S", "2"))
+        self.limiter = AdaptiveLimiter(
+            initial=max(1, max_limit // 2),
+            min_limit=int(_env(name, "MIN_CONCURRENCY", "2")),
+            max_limit=max_limit,
+            max_queue=int(_env(name, "MAX_QUEUE", "32")),
+            latency_target_s=float(_env(name, "LATENCY_TARGET_S", str(latency_target_s))),
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(_env(name, "BREAKER_FAILURES", "5")),
+            reset_after_s=float(_env(name, "BREAKER_RESET_S", "30")),
+        )
+        self.counters: Dict[str, int] = {
+            "calls": 0, "successes": 0, "failures": 0, "retries": 0,
+            "shed_queue": 0, "shed_circuit_open": 0, "shed_deadline": 0,
+        }
+        self._lock = threading.Lock()
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.counters[key] += 1
+
+    def shed(self, reason: str) -> ProviderUnavailable:
+        """Counts a shed call for this provider and returns the error to raise."""
+        self._count(f"shed_{reason}")
+        return ProviderUnavailable(self.name, reason)
+
+    def call(self, fn: Callable[[float], T]) -> T:
+        """Runs fn(timeout_s) under this guard. Raises ProviderUnavailable when shedding."""
+        attempt = 0
+        while True:
+            left = remaining()
+            if left is not None and left < MIN_ATTEMPT_S:
+                raise self.shed("deadline")
+
+            queue_wait = self.queue_timeout_s if left is None else min(self.queue_timeout_s, left)
+            if not self.limiter.acquire(queue_wait):
+                raise self.shed("queue")
+
+            # checked last so a half-open probe slot is only taken by a call that will run
+            if not self.breaker.allow():
+                self.limiter.release(None, ok=True)
+                raise self.shed("circuit_open")
+
+            left = remaining()
+            timeout = self.call_timeout_s if left is None else max(MIN_ATTEMPT_S, min(self.call_timeout_s, left))
+
+            self._count("calls")
+            t0 = time.monotonic()
+            try:
+                result = fn(timeout)
+            except Exception as e:
+                retryable = is_retryable(e)
+                self.limiter.release(None, ok=not retryable)
+                if not retryable:
+                    # the provider answered (bad request, parse failure): not its health problem
+                    self.breaker.record_success()
+                    raise
+                self._count("failures")
+                self.breaker.record_failure()
+
+                left = remaining()
+                backoff = random.uniform(0, min(self.backoff_cap_s, self.backoff_base_s * (2 ** attempt)))
+                if attempt >= self.max_retries or (left is not None and left - backoff < MIN_ATTEMPT_S):
+                    raise
+                attempt += 1
+                self._count("retries")
+                time.sleep(backoff)
+                continue
+
+            self.limiter.release(time.monotonic() - t0, ok=True)
+            self.breaker.record_success()
+            self._count("successes")
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "breaker_state": self.breaker.state,
+            "concurrency_limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "queue_depth": self.limiter.waiting,
+            **counters,
+        }
+
+# latency targets: the router and embeddings are quick, LLM-B completions are not
+GUARDS: Dict[str, ProviderGuard] = {
+    "openai": ProviderGuard("openai", latency_target_s=5.0),
+    "anthropic": ProviderGuard("anthropic", latency_target_s=20.0),
+}
+
+def guard(provider: str) -> ProviderGuard:
+    return GUARDS[provider]
+
+def metrics() -> Dict[str, Any]:
+    return {name: g.stats() for name, g in GUARDS.items()}
@@ -0,0 +1,78 @@
+import json
+import hashlib
+import threading
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from app.runtime.resilience import ProviderUnavailable, guard, remaining
+
+T = TypeVar("T")
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+_lock = threading.Lock()
+_inflight: Dict[str, _Call] = {}
+
+# per-request list of upstream calls that were served by another request's in-flight call
+_coalesced: ContextVar[Optional[List[str]]] = ContextVar("coalesced", default=None)
+
+def make_key(kind: str, inputs: Any) -> str:
+    payload = json.dumps(inputs, sort_keys=True, default=str)
+    return f"{kind}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+def track_coalesced() -> List[str]:
+    """
+    Starts a fresh coalescing log for the current request and returns it.
+    coalesce() appends the call kind each time this request shares another's result.
+    """
+    log: List[str] = []
+    _coalesced.set(log)
+    return log
+
+def coalesce(kind: str, inputs: Any, fn: Callable[[], T], provider: Optional[str] = None) -> T:
+    """
+    Single-flight: concurrent calls with the same kind and inputs share one fn() call.
+
+    The first caller runs fn(); callers arriving while it is in flight wait for it and get
+    the same result (or the same exception). Nothing is cached once the call completes.
+    Results are shared objects, so callers must treat them as read-only.
+
+    A waiting caller still honours its own request deadline: when it runs out first,
+    ProviderUnavailable(provider, "deadline") is raised and counted against provider's guard.
+    """
+    key = make_key(kind, inputs)
+
+    with _lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _inflight[key] = call
+
+    if not leader:
+        left = remaining()
+        if not call.done.wait(timeout=None if left is None else max(0.0, left)):
+            if provider is not None:
+                raise guard(provider).shed("deadline")
+            raise ProviderUnavailable(kind, "deadline")
+        log = _coalesced.get()
+        if log is not None:
+            log.append(kind)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = fn()
+        return call.result
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+        call.done.set()
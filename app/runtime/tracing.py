@@ -0,0 +1,218 @@
+import os
+import json
+import atexit
+import time
+import queue
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+TRACE_LEVELS = ("off", "summary", "full")
+
+# what goes back in ChatResponse.trace unless the request asks otherwise
+TRACE_LEVEL = os.getenv("TRACE_LEVEL", "summary")
+
+# caps for traces returned in responses (the sink always gets the uncapped trace)
+TRACE_MAX_CHARS = int(os.getenv("TRACE_MAX_CHARS", "300"))
+TRACE_MAX_ITEMS = int(os.getenv("TRACE_MAX_ITEMS", "5"))
+
+# full traces are written here in the background: *.jsonl, or *.db / *.sqlite for SQLite
+TRACE_SINK_PATH = os.getenv("TRACE_SINK_PATH")
+TRACE_SINK_BATCH = int(os.getenv("TRACE_SINK_BATCH", "100"))
+TRACE_SINK_FLUSH_S = float(os.getenv("TRACE_SINK_FLUSH_S", "1.0"))
+TRACE_SINK_MAX_QUEUE = int(os.getenv("TRACE_SINK_MAX_QUEUE", "10000"))
+# how long process exit waits for the sink to write out what is still queued
+TRACE_SINK_CLOSE_TIMEOUT_S = float(os.getenv("TRACE_SINK_CLOSE_TIMEOUT_S", "5.0"))
+
+def resolve_level(requested: Optional[str]) -> str:
+    level = requested or TRACE_LEVEL
+    return level if level in TRACE_LEVELS else "summary"
+
+def cap(value: Any, max_chars: int = TRACE_MAX_CHARS, max_items: int = TRACE_MAX_ITEMS) -> Any:
+    """Copy of value with long strings truncated and long lists cut to max_items."""
+    if isinstance(value, str):
+        if len(value) <= max_chars:
+            return value
+        return value[:max_chars] + f"...[+{len(value) - max_chars} chars]"
+    if isinstance(value, dict):
+        return {k: cap(v, max_chars, max_items) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [cap(v, max_chars, max_items) for v in value[:max_items]]
+        if len(value) > max_items:
+            items.append(f"...[+{len(value) - max_items} items]")
+        return items
+    return value
+
+def summarize(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """A few hundred bytes describing how the turn was handled."""
+    safety = trace.get("safety", {}).get("deterministic", {})
+    routing = trace.get("routing", {})
+    plan = routing.get("llm_plan") or {}
+    execution = trace.get("execution", {})
+
+    summary: Dict[str, Any] = {
+        "blocked": safety.get("blocked"),
+        "mode": routing.get("mode"),
+        "actions": routing.get("actions"),
+        "confidence": plan.get("confidence"),
+        "router_error": routing.get("llm_plan_error"),
+        "tools": [
+            {"name": call.get("name"), "found": call.get("output", {}).get("found")}
+            for call in execution.get("tool", {}).get("calls", [])
+        ],
+        "rag": [
+            {"doc_id": hit.get("doc_id"), "chunk_id": hit.get("chunk_id"), "score": round(hit.get("score", 0.0), 4)}
+            for hit in execution.get("rag", {}).get("hits", [])
+        ],
+        "answered_by": execution.get("answered_by"),
+        "degraded": trace.get("degraded"),
+        "coalesced": trace.get("coalesced"),
+    }
+    return cap({k: v for k, v in summary.items() if v not in (None, [], {})})
+
+def shape(trace: Dict[str, Any], level: str) -> Dict[str, Any]:
+    if level == "off":
+        return {}
+    if level == "full":
+        return cap(trace)
+    return summarize(trace)
+
+# ---------------------------------------------------------------------------
+# background trace sink
+# ---------------------------------------------------------------------------
+
+class TraceSink:
+    """
+    Batches full traces off the request path and appends them to a JSONL or SQLite file.
+    emit() never blocks: when the queue is full the trace is dropped and counted.
+    close() (run at process exit) writes out whatever is still queued.
+    """
+    _STOP: Dict[str, Any] = {}
+
+    def __init__(self, path: str):
+        self.path = path
+        self.use_sqlite = path.endswith((".db", ".sqlite", ".sqlite3"))
+        self.queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=TRACE_SINK_MAX_QUEUE)
+        self.counters = {"written": 0, "dropped": 0, "errors": 0}
+        self._pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self) -> None:
+        # started lazily per process, so a gunicorn master never owns the thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="trace-sink", daemon=True)
+            self._thread.start()
+        # the thread is a daemon, so without this whatever is queued dies with the process
+        atexit.register(self.close)
+
+    def _count(self, key: str, n: int = 1) -> None:
+        # bumped from request threads and the writer thread
+        with self._lock:
+            self.counters[key] += n
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        self._ensure_worker()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._count("dropped")
+
+    def _run(self) -> None:
+        conn = None
+        if self.use_sqlite:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS traces ("
+                "request_id TEXT PRIMARY KEY, ts REAL NOT NULL, route TEXT, record TEXT NOT NULL)"
+            )
+            conn.commit()
+
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + TRACE_SINK_FLUSH_S
+            while len(batch) < TRACE_SINK_BATCH:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=left))
+                except queue.Empty:
+                    break
+
+            if any(record is self._STOP for record in batch):
+                # closing: take everything still queued along in this last write
+                stopping = True
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                batch = [record for record in batch if record is not self._STOP]
+            if not batch:
+                continue
+            try:
+                self._write(batch, conn)
+                self._count("written", len(batch))
+            except Exception:
+                self._count("errors")
+
+        if conn is not None:
+            conn.close()
+
+    def _write(self, batch: List[Dict[str, Any]], conn: Optional[sqlite3.Connection]) -> None:
+        lines = [json.dumps(record, default=str) for record in batch]
+        if conn is None:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            return
+        conn.executemany(
+            "INSERT OR REPLACE INTO traces (request_id, ts, route, record) VALUES (?, ?, ?, ?)",
+            [(r.get("request_id"), r.get("ts"), r.get("route"), line) for r, line in zip(batch, lines)],
+        )
+        conn.commit()
+
+    def close(self, timeout_s: float = TRACE_SINK_CLOSE_TIMEOUT_S) -> None:
+        """Writes out everything queued so far and stops this process's writer thread."""
+        with self._lock:
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            # the stop marker goes in behind every record already queued
+            self.queue.put(self._STOP, timeout=timeout_s)
+        except queue.Full:
+            return
+        thread.join(timeout_s)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+        return {"path": self.path, "queue_depth": self.queue.qsize(), **counters}
+
+SINK: Optional[TraceSink] = TraceSink(TRACE_SINK_PATH) if TRACE_SINK_PATH else None
+
+def record(request_id: str, route: str, telemetry: Dict[str, Any], trace: Dict[str, Any]) -> None:
+    if SINK is None:
+        return
+    SINK.emit({
+        "request_id": request_id,
+        "ts": time.time(),
+        "route": route,
+        "telemetry": telemetry,
+        "trace": trace,
+    })
+
+def close() -> None:
+    if SINK is not None:
+        SINK.close()
+
+def sink_stats() -> Optional[Dict[str, Any]]:
+    return SINK.stats() if SINK else None
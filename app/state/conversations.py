@@ -0,0 +1,58 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+# unset: history lives in this process only (fine for a single worker).
+# set to a file path: history is shared by every worker on the box through SQLite.
+CONVERSATION_DB = os.getenv("CONVERSATION_DB")
+
+# Keep last N messages (prevent token blowup)
+MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "10"))
+
+_MEMORY: Dict[str, List[Dict[str, str]]] = {}
+
+_local = threading.local()
+
+def _connect() -> sqlite3.Connection:
+    # one connection per thread per process; never reuse a connection across fork
+    conn: Optional[sqlite3.Connection] = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "pid", None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(CONVERSATION_DB, timeout=5.0)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS conversations ("
+        "session_id TEXT PRIMARY KEY, history TEXT NOT NULL, updated_at REAL NOT NULL)"
+    )
+    conn.commit()
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+def get_history(session_id: str) -> List[Dict[str, str]]:
+    if not CONVERSATION_DB:
+        return list(_MEMORY.get(session_id, []))
+
+    row = _connect().execute(
+        "SELECT history FROM conversations WHERE session_id = ?", (session_id,)
+    ).fetchone()
+    return json.loads(row[0]) if row else []
+
+def save_history(session_id: str, history: List[Dict[str, str]]) -> None:
+    history = history[-MAX_MESSAGES:]
+    if not CONVERSATION_DB:
+        _MEMORY[session_id] = history
+        return
+
+    conn = _connect()
+    conn.execute(
+        "INSERT INTO conversations (session_id, history, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(session_id) DO UPDATE SET history = excluded.history, updated_at = excluded.updated_at",
+        (session_id, json.dumps(history), time.time()),
+    )
+    conn.commit()
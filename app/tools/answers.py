@@ -0,0 +1,88 @@
+import os
+from typing import Any, Dict, List, Optional
+
+from app.router.schemas import RoutePlan
+
+# tools whose results can be rendered straight into an answer, skipping LLM-B
+TEMPLATE_TOOLS = {
+    name.strip()
+    for name in os.getenv("TEMPLATE_TOOLS", "lookup_fault_code,lookup_ecu_fitment").split(",")
+    if name.strip()
+}
+# tools whose "not found" results may also be templated; by default LLM-B handles those,
+# since a miss is often a mistyped code or vehicle that it can help the user with
+TEMPLATE_NOT_FOUND_TOOLS = {
+    name.strip()
+    for name in os.getenv("TEMPLATE_NOT_FOUND_TOOLS", "").split(",")
+    if name.strip()
+}
+# below this router confidence the lookup goes through LLM-B as usual
+TEMPLATE_MIN_CONFIDENCE = float(os.getenv("TEMPLATE_MIN_CONFIDENCE", "0.85"))
+
+def render_fault_code(output: Dict[str, Any]) -> str:
+    if not output.get("found"):
+        return f"I couldn't find {output.get('code') or 'that fault code'} in the demo database: {output.get('error')}"
+    return (
+        f"**{output['code']} - {output.get('title', '')}**\n\n"
+        f"{output.get('summary', '')}\n\n"
+        f"**Common causes:**\n- " + "\n- ".join(output.get("common_causes", [])) + "\n\n"
+        f"**Safe checks:**\n- " + "\n- ".join(output.get("safe_checks", []))
+    )
+
+def render_fitment(output: Dict[str, Any]) -> str:
+    query = output.get("query") or {}
+    vehicle = " ".join(str(query[k]) for k in ("year", "make", "model") if query.get(k))
+    if query.get("engine_detail"):
+        vehicle += f" ({query['engine_detail']})"
+
+    if not output.get("found"):
+        return f"I couldn't find a Link ECU fitment for {vehicle or 'that vehicle'}: {output.get('error')}"
+
+    lines = [f"**Link ECU fitment for {vehicle}:**"]
+    for match in output.get("matches", []):
+        # concat is the full vehicle description, which tells apart matches sharing a SKU
+        detail = match.get("concat") or (
+            f"{match.get('from_year_id')}-{match.get('to_year_id')}, {match.get('engine_detail')}"
+        )
+        line = f"- **{match.get('name')}** (SKU {match.get('sku')}): {detail}"
+        if match.get("fitment_notes"):
+            line += f". Note: {match['fitment_notes']}"
+        lines.append(line)
+    lines.append("\nPlease confirm fitment with your Link dealer before purchasing.")
+    return "\n".join(lines)
+
+RENDERERS = {
+    "lookup_fault_code": render_fault_code,
+    "lookup_ecu_fitment": render_fitment,
+}
+
+def tool_answer_from_results(tool_results: Dict[str, Any]) -> str:
+    """Deterministic markdown answer covering every tool call in tool_results."""
+    sections: List[str] = []
+    for call in tool_results.get("calls", []):
+        render = RENDERERS.get(call.get("name"))
+        if render:
+            sections.append(render(call.get("output", {})))
+    if not sections:
+        return "No tool calls were executed."
+    return "\n\n---\n\n".join(sections)
+
+def template_skip_reason(plan: RoutePlan, actions: List[str], tool_results: Optional[Dict[str, Any]]) -> Optional[str]:
+    """
+    None when the turn is a confident, pure lookup with real matches that can be answered from a template,
+    otherwise the reason it still needs LLM-B.
+    """
+    if actions != ["tool"]:
+        return "not_tool_only"
+    if plan.confidence < TEMPLATE_MIN_CONFIDENCE:
+        return "low_confidence"
+    if not tool_results or not tool_results.get("calls"):
+        return "no_tool_calls"
+    if tool_results.get("errors"):
+        return "tool_errors"
+    for call in tool_results["calls"]:
+        if call.get("name") not in TEMPLATE_TOOLS or call.get("name") not in RENDERERS:
+            return f"template_disabled:{call.get('name')}"
+        if not call.get("output", {}).get("found") and call.get("name") not in TEMPLATE_NOT_FOUND_TOOLS:
+            return "not_found"
+    return None
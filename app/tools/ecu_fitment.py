@@ -1,10 +1,13 @@
 import json
 import re
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 DATA_PATH = Path(__file__).resolve().parents[1] / "data" / "ecu_fitment.json"
 
+# read-only: loaded once per process (or once before fork, see gunicorn.conf.py)
+@lru_cache(maxsize=1)
 def load_fitment_data() -> List[Dict[str, Any]]:
     if not DATA_PATH.exists():
         raise FileNotFoundError(f"ecu_fitment.json not found at: {DATA_PATH}")
@@ -1,5 +1,6 @@
 import json
 import re
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Dict, Optional
 
@@ -7,6 +8,8 @@ DATA_PATH = Path(__file__).resolve().parents[1] / "data" / "fault_codes.json"
 
 _CODE_RE = re.compile(r"^[A-Z]\d{4}$")
 
+# read-only: loaded once per process (or once before fork, see gunicorn.conf.py)
+@lru_cache(maxsize=1)
 def load_fault_db() -> Dict[str, Any]:
     if not DATA_PATH.exists():
         return {}
@@ -0,0 +1,120 @@
+"""
+Throughput vs worker count for the multi-worker serving mode.
+
+Starts gunicorn (gunicorn.conf.py) with each worker count in turn, drives it with
+concurrent POST /chat requests and prints requests/sec and scaling efficiency.
+
+    python bench/bench_workers.py --workers 1 2 4 --requests 2000 --concurrency 64
+
+By default the providers are stubbed (bench/stub_providers.py) and a throwaway index is
+built with stub embeddings, so every request is a full tool + RAG turn (safety, routing,
+fault-code lookup, retrieval and reranking, answer) with no API keys or network.
+--stub-latency-ms adds a simulated provider round trip; --live uses the real providers
+and index instead.
+
+Each request numbers its message, so concurrent requests are never identical and the
+upstream calls are not coalesced; the "coalesced" column should stay at 0. Scaling
+numbers only mean something on a machine with at least as many cores as workers.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import httpx
+
+ROOT = Path(__file__).resolve().parents[1]
+
+def wait_until_up(base_url: str, proc: subprocess.Popen, timeout_s: float = 30.0) -> None:
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not come up within {timeout_s}s")
+
+def drive(base_url: str, message: str, total: int, concurrency: int) -> Dict[str, float]:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    with httpx.Client(base_url=base_url, limits=limits, timeout=60.0) as client:
+        def one(i: int) -> Tuple[float, bool]:
+            t = time.perf_counter()
+            resp = client.post("/chat", json={"message": f"{message} (request {i})", "session_id": f"bench-{i}"})
+            resp.raise_for_status()
+            return time.perf_counter() - t, bool(resp.json()["telemetry"].get("coalesced"))
+
+        # warm up connections and workers
+        list(ThreadPoolExecutor(concurrency).map(one, range(total, total + concurrency)))
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(one, range(total)))
+        elapsed = time.perf_counter() - t0
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "rps": total / elapsed,
+        "coalesced": sum(coalesced for _, coalesced in results),
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+    }
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--message", default="What does fault code P0123 mean, and how do I update my G5 firmware?")
+    parser.add_argument("--stub-latency-ms", type=float, default=0.0)
+    parser.add_argument("--live", action="store_true", help="call the real providers (needs API keys and a built index)")
+    args = parser.parse_args(argv)
+
+    base_env = dict(os.environ)
+    app_target = "app.main:app"
+    if not args.live:
+        base_env.update({
+            "STUB_LATENCY_MS": str(args.stub_latency_ms),
+            "RAG_INDEX_DIR": tempfile.mkdtemp(prefix="bench-index-"),
+        })
+        subprocess.run(
+            [sys.executable, "-m", "bench.stub_providers"],
+            cwd=ROOT, env=base_env, check=True, stdout=subprocess.DEVNULL,
+        )
+        app_target = "bench.stub_providers:stub_app()"
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    results = []
+    for n in args.workers:
+        env = {**base_env, "WEB_CONCURRENCY": str(n), "BIND": f"127.0.0.1:{args.port}"}
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", app_target],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_until_up(base_url, proc)
+            stats = drive(base_url, args.message, args.requests, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+        results.append((n, stats))
+
+    base_rps = results[0][1]["rps"] / results[0][0]
+    print(f"{'workers':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'scaling':>8} {'coalesced':>10}")
+    for n, stats in results:
+        print(
+            f"{n:>7} {stats['rps']:>9.1f} {stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+            f"{stats['rps'] / (base_rps * n):>8.0%} {stats['coalesced']:>10}"
+        )
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,110 @@
+"""
+Canned stand-ins for the OpenAI and Anthropic clients, used by bench_workers.py so a full
+tool + RAG turn runs with no network access or API keys. Nothing in app/ imports this:
+the clients are only swapped in by install(), in the bench's own processes.
+
+    RAG_INDEX_DIR=/tmp/stub-index python -m bench.stub_providers        # build a stub index
+    RAG_INDEX_DIR=/tmp/stub-index gunicorn -c gunicorn.conf.py 'bench.stub_providers:stub_app()'
+
+Embeddings are hashed bag-of-words vectors, so retrieval still ranks chunks sharing
+words with the query first; the index has to be built with them too, since stub vectors
+are not comparable with real ones. The router searches every collection and looks up any
+fault code in the message, and LLM-B answers with a fixed text. STUB_LATENCY_MS adds a
+simulated round trip to every call.
+"""
+import os
+import re
+import json
+import math
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+STUB_LATENCY_MS = float(os.getenv("STUB_LATENCY_MS", "0"))
+STUB_EMBED_DIM = int(os.getenv("STUB_EMBED_DIM", "256"))
+
+STUB_ANSWER = "Stub answer: the provider clients are replaced by canned responses (bench/stub_providers.py)."
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_FAULT_CODE_RE = re.compile(r"\b[PBCU][0-9]{4}\b", re.IGNORECASE)
+
+def _simulate_latency() -> None:
+    if STUB_LATENCY_MS > 0:
+        time.sleep(STUB_LATENCY_MS / 1000)
+
+def embed(text: str) -> List[float]:
+    vec = [0.0] * STUB_EMBED_DIM
+    for word in _WORD_RE.findall(text.lower()):
+        vec[zlib.crc32(word.encode("utf-8")) % STUB_EMBED_DIM] += 1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+def plan_for(message: str) -> Dict[str, Any]:
+    codes = [code.upper() for code in _FAULT_CODE_RE.findall(message)]
+    plan: Dict[str, Any] = {
+        "mode": "rag",
+        "actions": ["rag"],
+        "confidence": 0.9,
+        "reason": "stub router",
+        "rag_query": message,
+    }
+    if codes:
+        plan["mode"] = "hybrid"
+        plan["actions"] = ["rag", "tool"]
+        plan["tool_calls"] = [{"name": "lookup_fault_code", "args": {"code": code}} for code in codes]
+    return plan
+
+class _Embeddings:
+    def create(self, model: str, input: List[str], **kwargs: Any) -> Any:
+        _simulate_latency()
+        return SimpleNamespace(data=[SimpleNamespace(embedding=embed(text)) for text in input])
+
+class _Responses:
+    def parse(self, model: str, input: List[Dict[str, str]], text_format: Any, **kwargs: Any) -> Any:
+        _simulate_latency()
+        # the router sends "Route this request ...:\n" followed by its JSON context
+        content = input[-1]["content"]
+        message = json.loads(content[content.index("\n") + 1:]).get("message") or ""
+        return SimpleNamespace(output_parsed=text_format.model_validate(plan_for(message)))
+
+class _Messages:
+    def create(self, **kwargs: Any) -> Any:
+        _simulate_latency()
+        return SimpleNamespace(content=[SimpleNamespace(type="text", text=STUB_ANSWER)])
+
+class StubOpenAI:
+    def __init__(self) -> None:
+        self.embeddings = _Embeddings()
+        self.responses = _Responses()
+
+class StubAnthropic:
+    def __init__(self) -> None:
+        self.messages = _Messages()
+
+def install() -> None:
+    """Replaces the provider clients of the current process with the stubs."""
+    # the real clients are still constructed on import, and refuse to without a key
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    os.environ.setdefault("ANTHROPIC_API_KEY", "stub")
+
+    from app.rag import build_index, retriever
+    from app.router import llm_router
+    from app.llm import synthesizer
+
+    build_index.client = StubOpenAI()
+    retriever.client = StubOpenAI()
+    llm_router.client = StubOpenAI()
+    synthesizer.client = StubAnthropic()
+
+def stub_app() -> Any:
+    """gunicorn app factory: the real app, with stubbed provider clients."""
+    install()
+    from app.main import app
+    return app
+
+if __name__ == "__main__":
+    install()
+    from app.rag import build_index
+
+    build_index.main([])
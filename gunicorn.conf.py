@@ -0,0 +1,31 @@
+# Multi-worker serving: gunicorn -c gunicorn.conf.py app.main:app
+import gc
+import os
+import multiprocessing
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn_worker.UvicornWorker"
+# chat() is sync and waits on LLM calls, so keep the timeout above the slowest LLM-B answer
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+
+# import the app once in the master, so workers are forked with it already loaded
+preload_app = True
+
+def when_ready(server):
+    # runs in the master after the app import and before any worker is forked
+    from app.main import preload_assets
+
+    loaded = preload_assets()
+    server.log.info("Preloaded read-only assets: %s", loaded)
+
+    # move everything loaded so far out of the GC's reach, so collections in the
+    # workers don't write to (and un-share) those pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    if not os.getenv("CONVERSATION_DB") and workers > 1:
+        server.log.warning(
+            "CONVERSATION_DB is not set: conversation history is per worker. "
+            "Set it to a SQLite file path to share history between workers."
+        )